@@ -2,12 +2,18 @@
 
 import os
 import asyncio
+import functools
+import heapq
 import secrets
-import traceback
+import time
 import uvicorn
 import re
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from collections import OrderedDict, deque
 from contextlib import asynccontextmanager
+from dataclasses import dataclass
 
 from pyrogram import Client, filters, enums
 from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, ChatMemberUpdated
@@ -20,7 +26,6 @@ from pyrogram import raw
 from pyrogram.session import Session, Auth
 from fastapi.responses import HTMLResponse
 from fastapi.templating import Jinja2Templates
-import math
 
 # Project ki dusri files se important cheezein import karo
 from config import Config
@@ -35,6 +40,8 @@ async def lifespan(app: FastAPI):
     """
     Yeh function bot ko web server ke saath start aur stop karta hai.
     """
+    logging.getLogger().addHandler(log_handler)
+    log_listener.start()
     print("--- Lifespan: Server chalu ho raha hai... ---")
     
     await db.connect()
@@ -48,8 +55,7 @@ async def lifespan(app: FastAPI):
         print(f"✅ Main Bot [@{Config.BOT_USERNAME}] safaltapoorvak start ho gaya.")
 
         # --- MULTI-CLIENT STARTUP ---
-        multi_clients[0] = bot
-        work_loads[0] = 0
+        await add_client(bot)
         await initialize_clients()
         
         print(f"Verifying storage channel ({Config.STORAGE_CHANNEL})...")
@@ -71,8 +77,8 @@ async def lifespan(app: FastAPI):
 
         print("--- Lifespan: Startup safaltapoorvak poora hua. ---")
     
-    except Exception as e:
-        print(f"!!! FATAL ERROR: Bot startup ke dauraan error aa gaya: {traceback.format_exc()}")
+    except Exception:
+        logger.exception("!!! FATAL ERROR: Bot startup ke dauraan error aa gaya")
     
     yield
     
@@ -80,6 +86,8 @@ async def lifespan(app: FastAPI):
     if bot.is_initialized:
         await bot.stop()
     print("--- Lifespan: Shutdown poora hua. ---")
+    log_listener.stop()
+    logging.getLogger().removeHandler(log_handler)
 
 app = FastAPI(lifespan=lifespan)
 templates = Jinja2Templates(directory="templates")
@@ -101,8 +109,45 @@ class HideDLFilter(logging.Filter):
 logging.getLogger("uvicorn.access").addFilter(HideDLFilter())
 # --- FIX KHATAM ---
 
+# --- ERROR LOGGING: traceback formatting background thread mein hota hai, event loop block nahi hota ---
+class RawQueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Record ko waise hi queue mein daalo; format karna listener thread ka kaam hai
+        return record
+
+log_queue = queue.SimpleQueue()
+log_handler = RawQueueHandler(log_queue)
+_stderr_handler = logging.StreamHandler()
+_stderr_handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+# Listener aur root handler lifespan mein lagte hain, taaki "python app.py" mein module do baar import hone par log double na ho
+log_listener = QueueListener(log_queue, _stderr_handler)
+logger = logging.getLogger(__name__)
+
 bot = Client("SimpleStreamBot", api_id=Config.API_ID, api_hash=Config.API_HASH, bot_token=Config.BOT_TOKEN, in_memory=True)
-multi_clients = {}; work_loads = {}; class_cache = {}
+
+@dataclass(slots=True)
+class ClientSlot:
+    """ Ek client ki saari state ek jagah: client, load, streamer aur cached storage info. """
+    index: int
+    client: Client
+    load: int = 0  # saare chalu streams ke baaki bytes
+    streamer: "ByteStreamer" = None
+    dc_id: int = 0
+    test_mode: bool = False
+
+# Main bot hamesha CLIENTS[0] hota hai
+CLIENTS: list[ClientSlot] = []
+# (load, slot index) ka min-heap; purani (stale) entries pop karte waqt hata di jaati hain
+load_heap = []
+# Ek Range response mein max itne bytes bhejo, taaki client dobara range maange aur load balance ho sake
+MAX_RANGE_SIZE = 16 * 1024 * 1024
+# Ek stream ke liye ek saath kitne GetFile requests chal sakte hain
+PREFETCH_DEPTH = 2
+# (slot index, msg_id) -> (expiry, (FileId, file_size, mime_type, file_name)); LRU, sabse purana pehle hatega
+MEDIA_CACHE_SIZE = 4096
+# Itne seconds baad entry dobara fetch hogi, taaki file_reference purana na pade
+MEDIA_CACHE_TTL = 3600
+media_cache = OrderedDict()
 
 # =====================================================================================
 # --- MULTI-CLIENT LOGIC ---
@@ -131,12 +176,40 @@ async def start_client(client_id, bot_token):
             no_updates=True, 
             in_memory=True
         ).start()
-        work_loads[client_id] = 0
-        multi_clients[client_id] = client
+        await add_client(client)
         print(f"✅ Client {client_id} started successfully.")
     except Exception as e:
         print(f"!!! CRITICAL ERROR: Failed to start Client {client_id} - Error: {e}")
 
+async def add_client(client: Client) -> ClientSlot:
+    """ Started client ka slot banata hai; dc_id aur test_mode yahin cache ho jaate hain. """
+    dc_id = await client.storage.dc_id()
+    test_mode = await client.storage.test_mode()
+    slot = ClientSlot(len(CLIENTS), client, dc_id=dc_id, test_mode=test_mode)
+    slot.streamer = ByteStreamer(slot)
+    CLIENTS.append(slot)
+    heapq.heappush(load_heap, (0, slot.index))
+    return slot
+
+def add_load(slot: ClientSlot, delta: int):
+    """ Client ka work load badalta hai aur heap mein nayi entry daalta hai. """
+    slot.load += delta
+    heapq.heappush(load_heap, (slot.load, slot.index))
+    if len(load_heap) > 4 * len(CLIENTS) + 16:
+        # Bahut saari stale entries jama ho gayi hain, heap ko dobara banao
+        load_heap[:] = [(s.load, s.index) for s in CLIENTS]
+        heapq.heapify(load_heap)
+
+def least_loaded_client():
+    """ Sabse kam load wala slot deta hai, ya None agar koi client nahi hai. """
+    while load_heap:
+        load, index = load_heap[0]
+        slot = CLIENTS[index]
+        if slot.load == load:
+            return slot
+        heapq.heappop(load_heap)
+    return None
+
 async def initialize_clients():
     """ Saare additional clients ko initialize karta hai. """
     all_tokens = TokenParser.parse_from_env()
@@ -148,40 +221,63 @@ async def initialize_clients():
     tasks = [start_client(i, token) for i, token in all_tokens.items()]
     await asyncio.gather(*tasks)
 
-    if len(multi_clients) > 1:
-        print(f"✅ Multi-Client Mode Enabled. Total Clients: {len(multi_clients)}")
+    if len(CLIENTS) > 1:
+        print(f"✅ Multi-Client Mode Enabled. Total Clients: {len(CLIENTS)}")
 
 # =====================================================================================
 # --- HELPER FUNCTIONS ---
 # =====================================================================================
 
+SIZE_LABELS = ('B', 'KB', 'MB', 'GB')
+
 def get_readable_file_size(size_in_bytes):
     if not size_in_bytes:
         return '0B'
-    power = 1024
-    n = 0
-    power_labels = {0: 'B', 1: 'KB', 2: 'MB', 3: 'GB'}
-    while size_in_bytes >= power and n < len(power_labels) - 1:
-        size_in_bytes /= power
-        n += 1
-    return f"{size_in_bytes:.2f} {power_labels[n]}"
+    # bit_length se seedha pata chalta hai ki kaunsi 1024 ki power hai (float log ki rounding ke bina)
+    n = min((int(size_in_bytes).bit_length() - 1) // 10, len(SIZE_LABELS) - 1)
+    return f"{size_in_bytes / (1 << (10 * n)):.2f} {SIZE_LABELS[n]}"
+
+async def get_media_info(slot: ClientSlot, msg_id: int):
+    """ Storage message ki file details laata hai; hot links ke liye get_messages ko skip karta hai. """
+    key = (slot.index, msg_id)
+    entry = media_cache.get(key)
+    if entry is not None:
+        if entry[0] > time.monotonic():
+            media_cache.move_to_end(key)
+            return entry[1]
+        del media_cache[key]
+    msg = await slot.client.get_messages(Config.STORAGE_CHANNEL, msg_id)
+    m = msg.document or msg.video or msg.audio
+    if not m or msg.empty:
+        raise FileNotFoundError
+    info = (FileId.decode(m.file_id), m.file_size, m.mime_type, m.file_name)
+    media_cache[key] = (time.monotonic() + MEDIA_CACHE_TTL, info)
+    if len(media_cache) > MEDIA_CACHE_SIZE:
+        media_cache.popitem(last=False)
+    return info
+
+METADATA_PATTERN = re.compile(
+    r'((19|20)\d{2}|4k|2160p|1080p|720p|480p|360p|HEVC|x265|BluRay|WEB-DL|HDRip)',
+    re.IGNORECASE
+)
+ALNUM_PATTERN = re.compile(r'[^\W_]')
+UNSAFE_FILENAME_PATTERN = re.compile(r'[^\w .-]+')
 
 def mask_filename(name: str):
     if not name:
         return "Protected File"
     base, ext = os.path.splitext(name)
-    metadata_pattern = re.compile(
-        r'((19|20)\d{2}|4k|2160p|1080p|720p|480p|360p|HEVC|x265|BluRay|WEB-DL|HDRip)',
-        re.IGNORECASE
-    )
-    match = metadata_pattern.search(base)
+    match = METADATA_PATTERN.search(base)
     if match:
         title_part = base[:match.start()].strip(' .-_')
         metadata_part = base[match.start():]
     else:
         title_part = base
         metadata_part = ""
-    masked_title = ''.join(c if (i % 3 == 0 and c.isalnum()) else ('*' if c.isalnum() else c) for i, c in enumerate(title_part))
+    # Har alphanumeric ko '*' karo, phir har teesra character wapas original rakho
+    masked = list(ALNUM_PATTERN.sub('*', title_part))
+    masked[::3] = title_part[::3]
+    masked_title = ''.join(masked)
     return f"{masked_title} {metadata_part}{ext}".strip()
 
 # =====================================================================================
@@ -239,8 +335,8 @@ async def handle_file_upload(message: Message, user_id: int):
         button = InlineKeyboardMarkup([[InlineKeyboardButton("Get Link Now", url=verify_link)]])
         
         await message.reply_text("__✅ File Uploaded!__", reply_markup=button, quote=True)
-    except Exception as e:
-        print(f"!!! ERROR: {traceback.format_exc()}"); await message.reply_text("Sorry, something went wrong.")
+    except Exception:
+        logger.exception("!!! ERROR: File upload fail ho gaya"); await message.reply_text("Sorry, something went wrong.")
 
 @bot.on_message(filters.private & (filters.document | filters.video | filters.audio))
 async def file_handler(_, message: Message):
@@ -277,19 +373,19 @@ async def health_check():
     """
     return {"status": "ok", "message": "Server is healthy and running!"}
 
+# show.html mein koi server-side variable nahi hai (data /api/file se aata hai), isliye ek hi baar render karo
+SHOW_PAGE_HTML = templates.get_template("show.html").render()
+
 @app.get("/show/{unique_id}", response_class=HTMLResponse)
 async def show_page(request: Request, unique_id: str):
-    return templates.TemplateResponse(
-        "show.html",
-        {"request": request}
-    )
+    return HTMLResponse(SHOW_PAGE_HTML)
 
 @app.get("/api/file/{unique_id}", response_class=JSONResponse)
 async def get_file_details_api(request: Request, unique_id: str):
     message_id = await db.get_link(unique_id)
     if not message_id:
         raise HTTPException(status_code=404, detail="Link expired or invalid.")
-    main_bot = multi_clients.get(0)
+    main_bot = CLIENTS[0].client if CLIENTS else None
     if not main_bot:
         raise HTTPException(status_code=503, detail="Bot is not ready.")
     try:
@@ -300,7 +396,7 @@ async def get_file_details_api(request: Request, unique_id: str):
     if not media:
         raise HTTPException(status_code=404, detail="Media not found in the message.")
     file_name = media.file_name or "file"
-    safe_file_name = "".join(c for c in file_name if c.isalnum() or c in (' ', '.', '_', '-')).rstrip()
+    safe_file_name = UNSAFE_FILENAME_PATTERN.sub('', file_name).rstrip()
     mime_type = media.mime_type or "application/octet-stream"
     response_data = {
         "file_name": mask_filename(file_name),
@@ -312,55 +408,85 @@ async def get_file_details_api(request: Request, unique_id: str):
     }
     return response_data
 
+CHUNK_SIZE = 1024 * 1024
+
+def retrieve_task_exception(t: asyncio.Task):
+    """ Chhode gaye prefetch task ka exception padh leta hai, taaki "Task exception was never retrieved" na aaye. """
+    if not t.cancelled():t.exception()
+
+def compute_ranges(fb:int,ub:int,cs:int):
+    """ Byte range [fb, ub] ke liye (offset, first_part_cut, last_part_cut, part_count), sirf integer ops se. """
+    fp,fc=divmod(fb,cs);lp,lr=divmod(ub,cs)
+    return fp*cs,fc,lr+1,lp-fp+1
+
+@functools.lru_cache(maxsize=8192)
+def document_location(media_id:int,access_hash:int,file_reference:bytes,thumb_size:str):
+    # Same file ke liye TL object dobara mat banao
+    return raw.types.InputDocumentFileLocation(id=media_id,access_hash=access_hash,file_reference=file_reference,thumb_size=thumb_size)
+
 class ByteStreamer:
-    def __init__(self,c:Client):self.client=c
+    def __init__(self,s:ClientSlot):self.slot=s
     @staticmethod
-    async def get_location(f:FileId): return raw.types.InputDocumentFileLocation(id=f.media_id,access_hash=f.access_hash,file_reference=f.file_reference,thumb_size=f.thumbnail_size)
-    async def yield_file(self,f:FileId,i:int,o:int,fc:int,lc:int,pc:int,cs:int):
-        c=self.client;work_loads[i]+=1;ms=c.media_sessions.get(f.dc_id)
+    def get_location(f:FileId): return document_location(f.media_id,f.access_hash,f.file_reference,f.thumbnail_size)
+    async def yield_file(self,f:FileId,o:int,fc:int,lc:int,pc:int,cs:int,ck=None):
+        s=self.slot;c=s.client;ms=c.media_sessions.get(f.dc_id)
         if ms is None:
-            if f.dc_id!=await c.storage.dc_id():
-                ak=await Auth(c,f.dc_id,await c.storage.test_mode()).create();ms=Session(c,f.dc_id,ak,await c.storage.test_mode(),is_media=True);await ms.start();ea=await c.invoke(raw.functions.auth.ExportAuthorization(dc_id=f.dc_id));await ms.invoke(raw.functions.auth.ImportAuthorization(id=ea.id,bytes=ea.bytes))
+            if f.dc_id!=s.dc_id:
+                ak=await Auth(c,f.dc_id,s.test_mode).create();ms=Session(c,f.dc_id,ak,s.test_mode,is_media=True);await ms.start();ea=await c.invoke(raw.functions.auth.ExportAuthorization(dc_id=f.dc_id));await ms.invoke(raw.functions.auth.ImportAuthorization(id=ea.id,bytes=ea.bytes))
             else:ms=c.session
             c.media_sessions[f.dc_id]=ms
-        loc=await self.get_location(f);cp=1
+        loc=self.get_location(f);cp=1;np=1;tasks=deque()
+        # Load = is stream ke abhi bheje jaane wale bytes; har chunk ke saath ghatta hai
+        left=(pc-1)*cs+lc-fc;add_load(s,left)
         try:
             while cp<=pc:
-                r=await ms.invoke(raw.functions.upload.GetFile(location=loc,offset=o,limit=cs),retries=0)
+                # Agla chunk pehle se mangwa lo, taaki socket write ke dauraan RTT chhup jaaye
+                while len(tasks)<PREFETCH_DEPTH and np<=pc:
+                    t=asyncio.create_task(ms.invoke(raw.functions.upload.GetFile(location=loc,offset=o,limit=cs),retries=0));t.add_done_callback(retrieve_task_exception)
+                    tasks.append(t);np+=1;o+=cs
+                # shield: disconnect par bhi GetFile poora ho, taaki Session apna results entry khud hata de
+                r=await asyncio.shield(tasks.popleft())
                 if isinstance(r,raw.types.upload.File):
-                    chk=r.bytes
+                    # memoryview slice se 1 MB chunk ki copy nahi banti
+                    chk=memoryview(r.bytes)
                     if not chk:break
-                    if pc==1:yield chk[fc:lc]
-                    elif cp==1:yield chk[fc:]
-                    elif cp==pc:yield chk[:lc]
-                    else:yield chk
-                    cp+=1;o+=cs
+                    # Pehle part ka start fc, aakhri part ka end lc; beech ke parts poore jaate hain
+                    part=chk[fc:lc if cp==pc else None];fc=0
+                    left-=len(part);add_load(s,-len(part))
+                    yield part
+                    cp+=1
                 else:break
-        finally:work_loads[i]-=1
+        except Exception:
+            # File reference expire ho sakta hai; agli request fresh details laaye
+            if ck is not None:media_cache.pop(ck,None)
+            raise
+        finally:
+            # Bache hue prefetch tasks cancel nahi karte: cancel hone par Session.results mein reply ka payload atka reh jaata hai
+            if left:add_load(s,-left)
 
 @app.get("/dl/{mid}/{fname}")
 async def stream_media(r:Request,mid:int,fname:str):
-    if not work_loads: raise HTTPException(503)
-    client_id = min(work_loads, key=work_loads.get)
-    c = multi_clients.get(client_id)
-    if not c: raise HTTPException(503)
-    
-    tc=class_cache.get(c) or ByteStreamer(c);class_cache[c]=tc
+    slot = least_loaded_client()
+    if slot is None: raise HTTPException(503)
+    ck=(slot.index,mid)
     try:
-        msg=await c.get_messages(Config.STORAGE_CHANNEL,mid);m=msg.document or msg.video or msg.audio
-        if not m or msg.empty:raise FileNotFoundError
-        fid=FileId.decode(m.file_id);fsize=m.file_size;rh=r.headers.get("Range","");fb,ub=0,fsize-1
+        fid,fsize,mime,name=await get_media_info(slot,mid);rh=r.headers.get("Range");fb,ub=0,fsize-1
         if rh:
-            rps=rh.replace("bytes=","").split("-");fb=int(rps[0])
-            if len(rps)>1 and rps[1]:ub=int(rps[1])
-        if(ub>=fsize)or(fb<0):raise HTTPException(416)
-        rl=ub-fb+1;cs=1024*1024;off=(fb//cs)*cs;fc=fb-off;lc=(ub%cs)+1;pc=math.ceil(rl/cs)
-        body=tc.yield_file(fid,client_id,off,fc,lc,pc,cs);sc=206 if rh else 200
-        hdrs={"Content-Type":m.mime_type or "application/octet-stream","Accept-Ranges":"bytes","Content-Disposition":f'inline; filename="{m.file_name}"',"Content-Length":str(rl)}
+            fbs,_,ubs=rh.removeprefix("bytes=").partition("-")
+            try:
+                if fbs:fb=int(fbs);ub=int(ubs) if ubs else ub
+                else:fb=max(fsize-int(ubs),0)  # "bytes=-N": aakhri N bytes
+            except ValueError:raise HTTPException(416)
+        if(ub>=fsize)or(fb<0)or(fb>ub):raise HTTPException(416)
+        if rh:ub=min(ub,fb+MAX_RANGE_SIZE-1)
+        rl=ub-fb+1;cs=CHUNK_SIZE;off,fc,lc,pc=compute_ranges(fb,ub,cs)
+        body=slot.streamer.yield_file(fid,off,fc,lc,pc,cs,ck);sc=206 if rh else 200
+        hdrs={"Content-Type":mime or "application/octet-stream","Accept-Ranges":"bytes","Content-Disposition":f'inline; filename="{name}"',"Content-Length":str(rl)}
         if rh:hdrs["Content-Range"]=f"bytes {fb}-{ub}/{fsize}"
         return StreamingResponse(body,status_code=sc,headers=hdrs)
-    except FileNotFoundError:raise HTTPException(404)
-    except Exception:print(traceback.format_exc());raise HTTPException(500)
+    except HTTPException:raise
+    except FileNotFoundError:media_cache.pop(ck,None);raise HTTPException(404)
+    except Exception:media_cache.pop(ck,None);logger.exception("Error in /dl route");raise HTTPException(500)
 
 # =====================================================================================
 # --- MAIN EXECUTION BLOCK ---
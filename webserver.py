@@ -1,8 +1,12 @@
 # webserver.py (FULL, COMPLETE CODE for the main.py structure)
 
-import math
-import traceback
+import functools
+import asyncio
+import re
+import logging
 import os
+import weakref
+from collections import deque
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.responses import HTMLResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
@@ -15,18 +19,30 @@ from config import Config
 from bot import multi_clients, work_loads, get_readable_file_size
 from database import db
 
+logger = logging.getLogger(__name__)
+
 # FastAPI app instance, started by main.py
 app = FastAPI()
 templates = Jinja2Templates(directory="templates")
 
-# A cache to store ByteStreamer instances to avoid re-creating them
-class_cache = {}
+# A cache to store ByteStreamer instances to avoid re-creating them.
+# Weak keys let an entry go away together with its client.
+class_cache = weakref.WeakKeyDictionary()
+
+# Cap each ranged response so one stream can't pin a client for a whole file
+MAX_RANGE_SIZE = 16 * 1024 * 1024
+
+# Number of GetFile requests kept in flight per stream
+PREFETCH_DEPTH = 2
 
 @app.api_route("/", methods=["GET", "HEAD"])
 async def root():
     """A simple health check route."""
     return {"status": "ok", "message": "Web server is healthy!"}
 
+NON_ALNUM_PATTERN = re.compile(r'[\W_]')
+UNSAFE_FILENAME_PATTERN = re.compile(r'[^\w .-]+')
+
 def mask_filename(name: str) -> str:
     """Obfuscates the filename to hide it in the URL/page."""
     if not name: return "Protected File"
@@ -38,21 +54,44 @@ def mask_filename(name: str) -> str:
             name = name.replace(res, "")
             break
     base, ext = os.path.splitext(name)
-    masked_base = ''.join(c if (i % 3 == 0 and c.isalnum()) else '*' for i, c in enumerate(base))
+    # Only every third character survives, and only if it is alphanumeric
+    masked = ['*'] * len(base)
+    masked[::3] = NON_ALNUM_PATTERN.sub('*', base[::3])
+    masked_base = ''.join(masked)
     return f"{masked_base}{res_part}{ext}"
 
+@functools.lru_cache(maxsize=8192)
+def document_location(media_id: int, access_hash: int, file_reference: bytes, thumb_size: str):
+    """Builds the InputDocumentFileLocation once per distinct file."""
+    return raw.types.InputDocumentFileLocation(
+        id=media_id,
+        access_hash=access_hash,
+        file_reference=file_reference,
+        thumb_size=thumb_size
+    )
+
+def retrieve_task_exception(task: asyncio.Task):
+    """Reads the result of an abandoned prefetch so its exception is never reported as unretrieved."""
+    if not task.cancelled():
+        task.exception()
+
 class ByteStreamer:
     """Handles the low-level logic of fetching file parts from Telegram."""
     def __init__(self, client: Client):
-        self.client = client
+        # Weak reference, otherwise the class_cache entry would keep its own key alive
+        self._client = weakref.ref(client)
+
+    @property
+    def client(self) -> Client:
+        return self._client()
 
     @staticmethod
-    async def get_location(file_id: FileId):
-        return raw.types.InputDocumentFileLocation(
-            id=file_id.media_id,
-            access_hash=file_id.access_hash,
-            file_reference=file_id.file_reference,
-            thumb_size=file_id.thumbnail_size
+    def get_location(file_id: FileId):
+        return document_location(
+            file_id.media_id,
+            file_id.access_hash,
+            file_id.file_reference,
+            file_id.thumbnail_size
         )
 
     async def yield_file(self, file_id: FileId, index: int, offset: int, first_part_cut: int, last_part_cut: int, part_count: int, chunk_size: int):
@@ -71,16 +110,27 @@ class ByteStreamer:
                 media_session = client.session
             client.media_sessions[file_id.dc_id] = media_session
         
-        location = await self.get_location(file_id)
+        location = self.get_location(file_id)
         current_part = 1
+        next_part = 1
+        pending = deque()
         try:
             while current_part <= part_count:
-                r = await media_session.invoke(
-                    raw.functions.upload.GetFile(location=location, offset=offset, limit=chunk_size),
-                    retries=0
-                )
+                # Keep the next chunk downloading while the current one is sent
+                while len(pending) < PREFETCH_DEPTH and next_part <= part_count:
+                    task = asyncio.create_task(media_session.invoke(
+                        raw.functions.upload.GetFile(location=location, offset=offset, limit=chunk_size),
+                        retries=0
+                    ))
+                    task.add_done_callback(retrieve_task_exception)
+                    pending.append(task)
+                    next_part += 1
+                    offset += chunk_size
+                # Shielded so a disconnect doesn't cancel the RPC mid-flight
+                r = await asyncio.shield(pending.popleft())
                 if isinstance(r, raw.types.upload.File):
-                    chunk = r.bytes
+                    # Slicing a memoryview avoids copying up to a whole chunk
+                    chunk = memoryview(r.bytes)
                     if not chunk: break
                     
                     if part_count == 1: yield chunk[first_part_cut:last_part_cut]
@@ -89,10 +139,11 @@ class ByteStreamer:
                     else: yield chunk
                     
                     current_part += 1
-                    offset += chunk_size
                 else:
                     break
         finally:
+            # Leftover prefetches are left to finish: a cancelled Session.send never
+            # pops its results entry, so the reply payload would stay there forever
             work_loads[index] -= 1
 
 @app.get("/show/{unique_id}", response_class=HTMLResponse)
@@ -114,7 +165,7 @@ async def show_file_page(request: Request, unique_id: str):
             raise HTTPException(status_code=404, detail="File not found in the message.")
         
         original_file_name = media.file_name or "file"
-        safe_file_name = "".join(c for c in original_file_name if c.isalnum() or c in (' ', '.', '_', '-')).rstrip()
+        safe_file_name = UNSAFE_FILENAME_PATTERN.sub('', original_file_name).rstrip()
 
         context = {
             "request": request,
@@ -130,7 +181,7 @@ async def show_file_page(request: Request, unique_id: str):
     except HTTPException:
         raise
     except Exception as e:
-        print(f"Error in /show route: {traceback.format_exc()}")
+        logger.exception("Error in /show route")
         raise HTTPException(status_code=500, detail="Internal server error.")
 
 @app.get("/dl/{msg_id}/{file_name}")
@@ -144,9 +195,8 @@ async def stream_handler(request: Request, msg_id: int, file_name: str):
             raise HTTPException(status_code=503, detail="No available clients to handle the request.")
         
         tg_connect = class_cache.get(client)
-        if not tg_connect:
-            tg_connect = ByteStreamer(client)
-            class_cache[client] = tg_connect
+        if tg_connect is None:
+            tg_connect = class_cache.setdefault(client, ByteStreamer(client))
             
         message = await client.get_messages(Config.STORAGE_CHANNEL, msg_id)
         media = message.document or message.video or message.audio
@@ -156,23 +206,34 @@ async def stream_handler(request: Request, msg_id: int, file_name: str):
         file_id = FileId.decode(media.file_id)
         file_size = media.file_size
         
-        range_header = request.headers.get("Range", 0)
+        range_header = request.headers.get("Range")
         from_bytes, until_bytes = 0, file_size - 1
         if range_header:
-            from_bytes_str, until_bytes_str = range_header.replace("bytes=", "").split("-")
-            from_bytes = int(from_bytes_str)
-            if until_bytes_str:
-                until_bytes = int(until_bytes_str)
+            from_bytes_str, _, until_bytes_str = range_header.removeprefix("bytes=").partition("-")
+            try:
+                if from_bytes_str:
+                    from_bytes = int(from_bytes_str)
+                    if until_bytes_str:
+                        until_bytes = int(until_bytes_str)
+                else:
+                    # Suffix range ("bytes=-N") asks for the last N bytes
+                    from_bytes = max(file_size - int(until_bytes_str), 0)
+            except ValueError:
+                raise HTTPException(status_code=416, detail="Requested range not satisfiable")
         
-        if (until_bytes >= file_size) or (from_bytes < 0):
+        if (until_bytes >= file_size) or (from_bytes < 0) or (from_bytes > until_bytes):
             raise HTTPException(status_code=416, detail="Requested range not satisfiable")
+        if range_header:
+            # Clients re-request the rest, giving the dispatcher a chance to rebalance
+            until_bytes = min(until_bytes, from_bytes + MAX_RANGE_SIZE - 1)
         
         req_length = until_bytes - from_bytes + 1
         chunk_size = 1024 * 1024  # 1 MB
         offset = (from_bytes // chunk_size) * chunk_size
         first_part_cut = from_bytes - offset
         last_part_cut = (until_bytes % chunk_size) + 1
-        part_count = math.ceil(req_length / chunk_size)
+        # Count the chunks the range actually touches; ceil(req_length / chunk_size) misses unaligned spans
+        part_count = until_bytes // chunk_size - offset // chunk_size + 1
         
         body = tg_connect.yield_file(file_id, index, offset, first_part_cut, last_part_cut, part_count, chunk_size)
         
@@ -188,8 +249,10 @@ async def stream_handler(request: Request, msg_id: int, file_name: str):
         
         return StreamingResponse(content=body, status_code=status_code, headers=headers)
         
+    except HTTPException:
+        raise
     except FileNotFoundError:
         raise HTTPException(status_code=404, detail="File not found on Telegram.")
     except Exception as e:
-        print(f"Error in /dl route: {traceback.format_exc()}")
+        logger.exception("Error in /dl route")
         raise HTTPException(status_code=500, detail="Internal streaming error.")